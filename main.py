@@ -1,20 +1,214 @@
+from __future__ import annotations
+
 import argparse
+import copy
 import datetime
+import functools
+import gzip
+import itertools
+import shelve
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+# folium and pyhafas are imported lazily in the functions that need them,
+# so cheap code paths like --help do not pay their import cost
+if TYPE_CHECKING:
+    from pyhafas import HafasClient
+    from pyhafas.types.fptf import Station
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> HafasClient:
+    """Creates the HafasClient with the DBProfile on first use and reuses it afterwards.
+
+    Returns:
+        pyhafas.HafasClient: The shared client for all HAFAS requests.
+    """
+    import requests
+    from pyhafas import HafasClient
+    from pyhafas.profile import DBProfile
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Create a session with keep-alive and retries that is shared by all HAFAS requests,
+    # so consecutive calls reuse the TLS connection instead of doing a new handshake each time
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # Create a HafasClient object with the DBProfile using the shared session
+    profile = DBProfile()
+    profile.request_session = session
+    return HafasClient(profile)
+
+# Directory where the persistent caches for the HAFAS responses are stored
+CACHE_DIR = Path.home() / ".cache" / "trip_viz"
+# Cached station lookups stay valid for 30 days because the station list barely changes
+LOCATIONS_CACHE_TTL = 30 * 24 * 60 * 60
+# Cached journeys expire after 60 seconds because the timetable data is volatile
+JOURNEYS_CACHE_TTL = 60
+# Serializes access to the shelve files, which do not support concurrent writers
+_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_locations(station_str: str) -> tuple:
+    """Looks up the locations for a station string with a persistent cache.
+
+    Args:
+        station_str (str): The name of the station to look up.
+
+    Returns:
+        tuple[pyhafas.types.fptf.Station]: The stations found for the station string.
+    """
+    # Normalize the station string so e.g. "Berlin Hbf" and " berlin hbf " share one cache entry
+    cache_key = station_str.strip().lower()
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with _cache_lock, shelve.open(str(CACHE_DIR / "locations")) as cache:
+        entry = cache.get(cache_key)
+        # If the entry exists and has not expired yet, use the cached stations
+        if entry is not None and time.time() - entry["timestamp"] < LOCATIONS_CACHE_TTL:
+            return entry["locations"]
+    # Ask the HAFAS API outside the lock, so multiple lookups can run in parallel
+    locations = tuple(_get_client().locations(station_str))
+    with _cache_lock, shelve.open(str(CACHE_DIR / "locations")) as cache:
+        cache[cache_key] = {"timestamp": time.time(), "locations": locations}
+    return locations
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_journeys(origin_id: str, destination_id: str, date: datetime.datetime) -> list:
+    """Queries the journeys between two stations with a persistent cache.
+
+    Args:
+        origin_id (str): The id of the origin station.
+        destination_id (str): The id of the destination station.
+        date (datetime.datetime): The date and time when the journey should start.
+
+    Returns:
+        list[pyhafas.types.fptf.Journey]: The journeys found between the two stations.
+    """
+    cache_key = f"{origin_id}|{destination_id}|{date.isoformat()}"
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with shelve.open(str(CACHE_DIR / "journeys")) as cache:
+        entry = cache.get(cache_key)
+        # If the entry exists and has not expired yet, use the cached journeys
+        if entry is not None and time.time() - entry["timestamp"] < JOURNEYS_CACHE_TTL:
+            return entry["journeys"]
+        # Otherwise ask the HAFAS API and store the result together with a timestamp
+        journeys = _get_client().journeys(
+            origin=origin_id,
+            destination=destination_id,
+            date=date
+        )
+        cache[cache_key] = {"timestamp": time.time(), "journeys": journeys}
+    return journeys
+
+
+def get_journeys(origin: Station, destination: Station, date: datetime.datetime) -> list:
+    """Returns the journeys between two stations, using the cache when possible.
+
+    Args:
+        origin (pyhafas.types.fptf.Station): The origin station.
+        destination (pyhafas.types.fptf.Station): The destination station.
+        date (datetime.datetime): The date and time when the journey should start.
+
+    Returns:
+        list[pyhafas.types.fptf.Journey]: The journeys found between the two stations.
+    """
+    # Key the cache by the station ids and the date, as the Station objects are not hashable
+    return _cached_journeys(origin.id, destination.id, date)
+
+
+def _stations_db() -> sqlite3.Connection:
+    """Opens the persistent index of previously selected stations, creating it if needed.
+
+    Returns:
+        sqlite3.Connection: The connection to the station index database.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(CACHE_DIR / "stations.sqlite3"))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS stations ("
+        "name TEXT PRIMARY KEY, id TEXT NOT NULL, latitude REAL, longitude REAL, "
+        "hits INTEGER NOT NULL DEFAULT 0)"
+    )
+    return connection
+
+
+def _lookup_known_station(station_str: str) -> Station:
+    """Looks up a station in the index of previously selected stations by name prefix.
+
+    Args:
+        station_str (str): The (possibly partial) name of the station, e.g. "Münch".
+
+    Returns:
+        pyhafas.types.fptf.Station: The station if one clearly dominates the previous
+            selections for this prefix, otherwise None.
+    """
+    from pyhafas.types.fptf import Station
+
+    with closing(_stations_db()) as db:
+        rows = db.execute(
+            "SELECT name, id, latitude, longitude, hits FROM stations "
+            "WHERE name LIKE ? || '%' ORDER BY hits DESC LIMIT 5",
+            (station_str.strip(),),
+        ).fetchall()
+    if len(rows) == 0:
+        return None
+    # Only skip the HAFAS lookup and the prompt if the best match was selected often
+    # and clearly more often than the second best one
+    name, station_id, latitude, longitude, hits = rows[0]
+    if hits >= 3 and (len(rows) == 1 or hits >= 3 * rows[1][4]):
+        return Station(id=station_id, name=name, latitude=latitude, longitude=longitude)
+    return None
+
+
+def _remember_station(station: Station) -> None:
+    """Records a selected station in the index, so it can be offered without a prompt later.
+
+    Args:
+        station (pyhafas.types.fptf.Station): The station the user selected.
+    """
+    with closing(_stations_db()) as db, db:
+        db.execute(
+            "INSERT INTO stations (name, id, latitude, longitude, hits) VALUES (?, ?, ?, ?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET hits = hits + 1",
+            (station.name, station.id, station.latitude, station.longitude),
+        )
+
+
+def _parse_start_time(start_time_str: str) -> datetime.datetime:
+    """Parses a start time in the format YYYY-MM-DDTHH:MM.
 
-import folium
-from folium.plugins import LocateControl, MeasureControl
-from pyhafas import HafasClient
-from pyhafas.profile import DBProfile
-from pyhafas.types.fptf import Station
+    Args:
+        start_time_str (str): The start time string to parse.
+
+    Returns:
+        datetime.datetime: The parsed start time.
+    """
+    # fromisoformat handles this format directly and is much faster than strptime
+    return datetime.datetime.fromisoformat(start_time_str)
 
-# Create a HafasClient object with the DBProfile
-hafas_client = HafasClient(DBProfile())
 
 def convert_station_str_to_station(station_str: str) -> Station:
-    
-    # Get the locations for the station string from the HAFAS API
-    locations = hafas_client.locations(station_str)
+
+    # If a previously selected station clearly matches the input, use it without asking
+    known_station = _lookup_known_station(station_str)
+    if known_station is not None:
+        print(f"Using previously selected station: {known_station.name}")
+        _remember_station(known_station)
+        return known_station
+
+    # Get the locations for the station string from the cache or the HAFAS API
+    locations = _cached_locations(station_str)
     station = None
 
     # If no locations are found, print an error message and exit
@@ -39,64 +233,214 @@ def convert_station_str_to_station(station_str: str) -> Station:
         except IndexError:
             print("Invalid index")
             sys.exit(1)
+    # Record the selection, so the prompt can be skipped for this station in the future
+    _remember_station(station)
     return station
 
     
             
     
-def draw(journey,only_transfer_stations=False):
-    # Create a map with the location of the origin station as the center
-    origin_lat, origin_lon = journey.legs[0].origin.latitude, journey.legs[0].origin.longitude
-    map = folium.Map(location= [origin_lat, origin_lon],zoom_start=8)
-    
+# Tolerance for the polyline simplification in degrees, roughly 50 meters
+SIMPLIFY_EPSILON = 0.0005
+# Maximum number of vertices per polyline chunk, so Leaflet can cull off-screen pieces
+POLYLINE_CHUNK_SIZE = 64
+# Format for the departure and arrival times shown in the popups and route listing
+TIME_FORMAT = "%H:%M %d.%m.%Y"
+# Colors for the leg polylines, repeated when a journey has more legs than colors
+LEG_COLORS = ("Red","Blue","Green","Black","White")
+
+
+def _stop_time(stopover) -> str:
+    """Returns the formatted departure time of a stopover, falling back to the arrival time.
+
+    Args:
+        stopover (pyhafas.types.fptf.Stopover): The stopover to format the time for.
+
+    Returns:
+        str: The formatted time, or "unknown" if the stopover has neither time.
+    """
+    stop_time = stopover.departure if stopover.departure is not None else stopover.arrival
+    return stop_time.strftime(TIME_FORMAT) if stop_time is not None else "unknown"
+
+# JavaScript callback for the marker cluster that draws one circle per stopover
+_STOPOVER_MARKER_CALLBACK = """
+function (row) {
+    var circle = L.circle(new L.LatLng(row[0], row[1]), {color: 'crimson', fill: true, radius: 1000});
+    circle.bindPopup(row[2]);
+    return circle;
+};
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def _base_map_template():
+    """Builds the base map with its controls once, draw() copies it for every journey.
+
+    Returns:
+        folium.Map: The base map with the locate and measure controls attached.
+    """
+    import folium
+    from folium.plugins import LocateControl, MeasureControl
+
+    # prefer_canvas makes Leaflet paint the lines and circles on a canvas instead of SVG DOM nodes
+    map = folium.Map(location=[0, 0], zoom_start=8, prefer_canvas=True)
+
     # Add the locate and measure controls to the map
     LocateControl().add_to(map)
     MeasureControl().add_to(map)
-    
+    return map
 
 
-    # initialize the transfer count for the color of the lines
-    transfer_count = 0
+def _copy_base_map():
+    """Returns a deep copy of the base map template with fresh element ids.
+
+    Returns:
+        folium.Map: An independent copy of the base map that can be modified freely.
+    """
+    import jinja2
+
+    template_map = _base_map_template()
+    # The compiled Jinja templates and the shared Jinja environment of the elements are
+    # global state that cannot be deep-copied, so share them between the copies via the
+    # memo instead of recompiling them
+    memo = {}
+    stack = [template_map.get_root()]
+    seen = set()
+    while stack:
+        element = stack.pop()
+        if id(element) in seen:
+            continue
+        seen.add(id(element))
+        for value in vars(element).values():
+            if isinstance(value, (jinja2.Template, jinja2.Environment)):
+                memo[id(value)] = value
+            elif isinstance(value, dict):
+                stack.extend(child for child in value.values() if hasattr(child, "_children"))
+            elif hasattr(value, "_children"):
+                stack.append(value)
+    return copy.deepcopy(template_map, memo)
+
+
+@functools.lru_cache(maxsize=1)
+def _enable_fast_json() -> bool:
+    """Switches the Jinja tojson filter used by the map templates to orjson, if available.
+
+    Returns:
+        bool: True if orjson is now used, False if the stdlib json stays active.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return False
+
+    from folium.features import GeoJson
+
+    def dumps(obj, **kwargs):
+        # Tuples are not supported natively by orjson, so convert them via the default hook
+        return orjson.dumps(obj, default=list, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    # All templates that folium builds with jinja2.Template share this environment
+    environment = GeoJson._template.environment
+    environment.policies["json.dumps_function"] = dumps
+    environment.policies["json.dumps_kwargs"] = {}
+    return True
+
+
+def draw(journey,only_transfer_stations=False, simplify=True):
+    # Import the drawing dependencies lazily, they are only needed when a map is actually drawn
+    import folium
+    import numpy as np
+    from folium.plugins import FastMarkerCluster
+    from rdp import rdp
+
+    # Copy the prepared base map instead of re-instantiating the plugins on every call,
+    # then center it on the location of the origin station
+    origin_lat, origin_lon = journey.legs[0].origin.latitude, journey.legs[0].origin.longitude
+    map = _copy_base_map()
+    map.location = [origin_lat, origin_lon]
+
+    # Let the Jinja tojson filter embed the route data with orjson when it is available,
+    # it serializes the coordinate arrays several times faster than the stdlib json
+    _enable_fast_json()
+
+    # initialize the color cycle for the leg polylines
+    leg_colors = itertools.cycle(LEG_COLORS)
+    # Collect the stopover markers of all legs so they can be added as one clustered layer
+    stopover_points = []
+    # Collect one LineString feature per polyline chunk, all embedded as a single GeoJSON blob
+    route_features = []
     # Iterate over the legs of the journey
-    for leg in journey.legs:
-        # Create a list of points for the polyline of this leg
-        route_line_points = []
+    for leg_index, leg in enumerate(journey.legs):
         # If only_transfer_stations is False, add all stopovers to the route_line_points list
         if only_transfer_stations == False:
-            for stopover in leg.stopovers:
+            # Preallocate a contiguous array for the polyline points and fill it by index
+            route_line_points = np.empty((len(leg.stopovers), 2), dtype=np.float64)
+            for i, stopover in enumerate(leg.stopovers):
+                # Bind the coordinates to locals once, they are used several times per iteration
                 stop = stopover.stop
-                # Add the location of the stopover to the route_line_points list for the polyline
-                route_line_points.append((stop.latitude,stop.longitude))
-                # Add a circle marker for the stopover to the map
-                folium.Circle(
-                    radius=1000,
-                    location=[stop.latitude,stop.longitude],
-                    popup=f"{stop.name} - {stopover.departure.strftime('%H:%M %d.%m.%Y') if stopover.departure is not None else stopover.arrival.strftime('%H:%M %d.%m.%Y') if stopover.arrival is not None else 'unknown'}",
-                    color="crimson",
-                    fill=True,
-                ).add_to(map)
-        else: 
-            # If only_transfer_stations is True, only add the origin and destination of the leg to the route_line_points list
-            route_line_points.append((leg.origin.latitude,leg.origin.longitude))
+                latitude = stop.latitude
+                longitude = stop.longitude
+                # Add the location of the stopover to the route_line_points array for the polyline
+                route_line_points[i] = (latitude,longitude)
+                # Build the popup text once per stopover and add it to the marker cluster points.
+                # join on precomputed strings is cheaper than an f-string here
+                popup = "".join((stop.name, " - ", _stop_time(stopover)))
+                stopover_points.append([latitude, longitude, popup])
+        else:
+            # If only_transfer_stations is True, only add the origin and destination of the leg
+            # to the route_line_points array and collect their markers in a feature group
+            feature_group = folium.FeatureGroup(name=f"leg_{leg_index}")
+            origin = leg.origin
+            destination = leg.destination
+            route_line_points = np.empty((2, 2), dtype=np.float64)
+            route_line_points[0] = (origin.latitude,origin.longitude)
             folium.Circle(
                 radius=1000,
-                location=[leg.origin.latitude,leg.origin.longitude],
-                popup=f"{leg.origin.name} - {leg.departure.strftime('%H:%M %d.%m.%Y')}",
+                location=[origin.latitude,origin.longitude],
+                # Pass a pre-rendered Popup, so folium does not parse the text per marker
+                popup=folium.Popup("".join((origin.name, " - ", leg.departure.strftime(TIME_FORMAT))), parse_html=False, max_width=250),
                 color="crimson",
                 fill=True,
-            ).add_to(map)
-            route_line_points.append((leg.destination.latitude,leg.destination.longitude))
+            ).add_to(feature_group)
+            route_line_points[1] = (destination.latitude,destination.longitude)
             folium.Circle(
                 radius=1000,
-                location=[leg.destination.latitude,leg.destination.longitude],
-                popup=f"{leg.destination.name} - {leg.arrival.strftime('%H:%M %d.%m.%Y')}",
+                location=[destination.latitude,destination.longitude],
+                popup=folium.Popup("".join((destination.name, " - ", leg.arrival.strftime(TIME_FORMAT))), parse_html=False, max_width=250),
                 color="crimson",
                 fill=True,
-            ).add_to(map)
-        # Add the polyline for the leg to the map
-        folium.PolyLine(route_line_points,color=["Red","Blue","Green","Black","White"][transfer_count%5]).add_to(map)
-        transfer_count += 1
-    
+            ).add_to(feature_group)
+            feature_group.add_to(map)
+        # Simplify the polyline so sub-pixel vertices are not sent to the browser
+        if simplify:
+            route_line_points = rdp(route_line_points, epsilon=SIMPLIFY_EPSILON)
+        # Turn the polyline for the leg into LineString features in chunks that share one
+        # vertex, so Leaflet can cull the chunks outside the current view while panning.
+        # GeoJSON expects the coordinates in (longitude, latitude) order
+        color = next(leg_colors)
+        points = route_line_points[:, ::-1].tolist()
+        for chunk_start in range(0, max(len(points) - 1, 1), POLYLINE_CHUNK_SIZE - 1):
+            route_features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": points[chunk_start:chunk_start + POLYLINE_CHUNK_SIZE],
+                },
+                "properties": {"color": color},
+            })
+
+    # Add all route lines as one GeoJSON layer, so the map gets a single child for them.
+    # smooth_factor lets Leaflet simplify the lines further on the fly while panning and zooming
+    folium.GeoJson(
+        data={"type": "FeatureCollection", "features": route_features},
+        style_function=lambda feature: {"color": feature["properties"]["color"]},
+        smooth_factor=2.0,
+    ).add_to(map)
+
+    # Add all stopover markers as one clustered layer, so the browser only draws the visible ones
+    if len(stopover_points) > 0:
+        FastMarkerCluster(stopover_points, callback=_STOPOVER_MARKER_CALLBACK).add_to(map)
+
     return map
 
 def draw_and_save_to_file(train_journey,only_transfer_stations=False, map_filename="output.html"):
@@ -105,18 +449,27 @@ def draw_and_save_to_file(train_journey,only_transfer_stations=False, map_filena
     Args:
         train_journey (pyhafas.types.fptf.Journey): The train journey to draw.
         only_transfer_stations (bool, optional): If True, only the transfer stations are drawn. Defaults to False.
-        map_filename (str, optional): The filename to save the map to. Defaults to "output.html".
+        map_filename (str, optional): The filename to save the map to. If it ends with ".html.gz" the map is gzip-compressed. Defaults to "output.html".
     """
-    # Draw the map and save it to a file
+    # Draw the map and render it to HTML once
     map = draw(train_journey,only_transfer_stations)
-    map.save(map_filename)
+    html = map.get_root().render()
+    # Write the HTML to the file, gzip-compressed if the filename asks for it
+    if map_filename.endswith(".html.gz"):
+        with gzip.open(map_filename, "wt", encoding="utf-8") as file:
+            file.write(html)
+    else:
+        with open(map_filename, "w", encoding="utf-8") as file:
+            file.write(html)
+    # Drop the rendered HTML right away, for large journeys it can be tens of MB
+    del html
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Scrape a journey from the DB API and convert it to JSON")
     parser.add_argument("-s", "--start",help="The name of the start station", type=str, dest="start_station_str")
     parser.add_argument("-d", "--destination",help="The name of the destination station", type=str, dest="destination_station_str")
-    parser.add_argument("-t", "--start-time",help="The start time of the journey in the format YYYY-MM-DDTHH:MM", required=False, type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M"), dest="start_time")
+    parser.add_argument("-t", "--start-time",help="The start time of the journey in the format YYYY-MM-DDTHH:MM", required=False, type=_parse_start_time, dest="start_time")
     args = parser.parse_args()
 
 
@@ -130,7 +483,7 @@ if __name__ == "__main__":
         else:
             args.start_time = input("Please enter the start time in the format YYYY-MM-DDTHH:MM: ")
             try:
-                args.start_time = datetime.datetime.strptime(args.start_time, "%Y-%m-%dT%H:%M")
+                args.start_time = _parse_start_time(args.start_time)
             except ValueError:
                 print("Invalid time format")
                 sys.exit(1)
@@ -140,22 +493,29 @@ if __name__ == "__main__":
     if args.destination_station_str is None:
         args.destination_station_str = input("Please enter the name of the destination station: ")
 
-    # Get the stations for the start and destination station strings and generate the journey
+    # Fetch the locations for both station strings in parallel, the two lookups are
+    # independent. Strings that the station index already resolves need no lookup at all.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(_cached_locations, station_str)
+            for station_str in (args.start_station_str, args.destination_station_str)
+            if _lookup_known_station(station_str) is None
+        ]
+        for future in futures:
+            future.result()
+    # Resolve the stations sequentially, so the disambiguation prompts do not interleave.
+    # The lookups above are already cached, so no further network requests are made here.
     start_station =  convert_station_str_to_station(args.start_station_str)
     destination_station = convert_station_str_to_station(args.destination_station_str)
-    journeys = hafas_client.journeys(
-        origin=start_station,
-        destination=destination_station,
-        date=args.start_time
-    )
+    journeys = get_journeys(start_station, destination_station, args.start_time)
 
     # Print the possible routes and ask the user to select one
     print(f"Found {len(journeys)} possible routes for your trip from {start_station.name} to {destination_station.name} at {args.start_time}")
     for i,journey in enumerate(journeys):
         if len(journey.legs) == 1:
-            print(f"- {i}: Journey starts at {journey.legs[0].departure.strftime('%H:%M %d.%m.%Y')} and ends at {journey.legs[-1].arrival.strftime('%H:%M %d.%m.%Y')}. The complete journey takes {journey.duration} and has no changes")
+            print(f"- {i}: Journey starts at {journey.legs[0].departure.strftime(TIME_FORMAT)} and ends at {journey.legs[-1].arrival.strftime(TIME_FORMAT)}. The complete journey takes {journey.duration} and has no changes")
         else:
-            print(f"- {i}: Journey starts at {journey.legs[0].departure.strftime('%H:%M %d.%m.%Y')} and ends at {journey.legs[-1].arrival.strftime('%H:%M %d.%m.%Y')}. The complete journey takes {journey.duration} and has {len(journey.legs)-1} changes (at {', '.join([leg.destination.name for leg in journey.legs[:-1]])})")
+            print(f"- {i}: Journey starts at {journey.legs[0].departure.strftime(TIME_FORMAT)} and ends at {journey.legs[-1].arrival.strftime(TIME_FORMAT)}. The complete journey takes {journey.duration} and has {len(journey.legs)-1} changes (at {', '.join([leg.destination.name for leg in journey.legs[:-1]])})")
     route_selection = int(input("Please select the journey you want to use: "))
     # If the user input is invalid, print an error message and exit
     if route_selection < 0 or route_selection >= len(journeys):